@@ -1,13 +1,53 @@
+import heapq
 import json
 import os
 import re
+import shutil
+import struct
+import sys
+import tempfile
+import time
+from array import array
 from collections import defaultdict, Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from postings import POSTINGS_FILENAME, write_postings, write_sorted_postings
+from segments import MANIFEST_FILENAME, SegmentMerger, init_segments, update_from_jsonl
 
 # ===============================
 # CONFIG
 # ===============================
 OUTPUT_DIR = "index"
-os.makedirs(OUTPUT_DIR, exist_ok=True)
+
+# The binary postings file replaces inverted_index.json; flip this on
+# only if something still needs the old JSON dump.
+WRITE_JSON_INDEX = False
+
+# Store quantized BM25 impact scores (8 or 16 bits per posting, None to
+# skip) so query time is integer accumulation. The k1/b used here are
+# recorded in postings.bin and checked at query time.
+IMPACT_BITS = 8
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# Once an index exists, only documents appended to the corpus since the
+# last run are indexed, as a new segment (see segments.py); small
+# segments are merged in the background. False forces a full rebuild.
+# doc_lengths.json / stats.json are only rewritten by full builds, the
+# segments carry their own doc lengths.
+INCREMENTAL = True
+
+# Full builds split the corpus into byte-range shards indexed by this many
+# worker processes (1 = the single-process build_index below).
+NUM_WORKERS = os.cpu_count() or 1
+
+# Bounded-memory build (build_index_spimi): postings are inverted in memory
+# until roughly this many MB are used, then flushed to disk as a sorted
+# run; the runs are k-way merged into postings.bin at the end. None keeps
+# the in-memory builders above (fine for the ~9.5k article corpora).
+MEMORY_BUDGET_MB = None
 
 CORPORA = {
     "bangla": "C:/Users/X1 Carbon/Documents/1UT/CLIR/Module_A/news_crawler/bangla_corpus.jsonl",
@@ -39,9 +79,11 @@ def build_index(language, corpus_path):
     total_docs = 0
     skipped_lines = 0
 
-    with open(corpus_path, "r", encoding="utf-8") as f:
-        for line_no, line in enumerate(f, start=1):
-            line = line.strip()
+    # binary mode so the byte offset reached can be recorded for
+    # incremental updates
+    with open(corpus_path, "rb") as f:
+        for line_no, raw in enumerate(f, start=1):
+            line = raw.decode("utf-8").strip()
 
             if not line:
                 continue
@@ -64,9 +106,12 @@ def build_index(language, corpus_path):
             for term, freq in tf.items():
                 inverted_index[term][doc_id] = freq
 
+        corpus_bytes = f.tell()
+
     stats = {
         "language": language,
         "total_documents": total_docs,
+        "corpus_bytes": corpus_bytes,
         "skipped_lines": skipped_lines,
         "vocabulary_size": len(inverted_index),
         "average_doc_length": (
@@ -77,26 +122,407 @@ def build_index(language, corpus_path):
     return inverted_index, doc_lengths, stats
 
 
+# ===============================
+# PARALLEL BUILD (SHARDED JSONL)
+# ===============================
+def shard_offsets(corpus_path, num_shards):
+    """
+    Split a JSONL file into byte ranges that start and end on line
+    boundaries. Returns a list of (start, end) offsets.
+    """
+    size = os.path.getsize(corpus_path)
+    bounds = [0]
+    with open(corpus_path, "rb") as f:
+        for i in range(1, num_shards):
+            f.seek(size * i // num_shards)
+            f.readline()  # move to the start of the next line
+            bounds.append(max(f.tell(), bounds[-1]))
+    bounds.append(size)
+    return [(a, b) for a, b in zip(bounds, bounds[1:]) if b > a]
+
+
+def index_shard(language, corpus_path, start, end):
+    """
+    Worker: tokenize and invert the lines in [start, end) of the corpus.
+
+    Doc ids are local to the shard (0, 1, ...); the parent shifts them by
+    the number of docs in earlier shards, which gives the same ids as the
+    sequential build_index.
+
+    Returns (terms, dfs, doc_ids, tfs, doc_lengths, skipped_lines) with
+    terms in UTF-8 order and the postings of each term as consecutive
+    slices of the flat doc_ids / tfs arrays.
+    """
+    postings = defaultdict(list)
+    doc_lengths = []
+    skipped_lines = 0
+
+    with open(corpus_path, "rb") as f:
+        f.seek(start)
+        offset = start
+        while offset < end:
+            raw = f.readline()
+            if not raw:
+                break
+            line_offset, offset = offset, offset + len(raw)
+            line = raw.decode("utf-8").strip()
+
+            if not line:
+                continue
+
+            try:
+                doc = json.loads(line)
+            except json.JSONDecodeError as e:
+                skipped_lines += 1
+                print(f"[WARN] Skipping bad JSON at byte {line_offset}: {e}")
+                continue
+
+            tokens = tokenize(doc.get("body", ""), language)
+            doc_id = len(doc_lengths)
+            doc_lengths.append(len(tokens))
+
+            for term, freq in Counter(tokens).items():
+                postings[term].append((doc_id, freq))
+
+    terms = sorted(postings, key=lambda t: t.encode("utf-8"))
+    dfs = np.fromiter((len(postings[t]) for t in terms), dtype=np.int64, count=len(terms))
+    flat = np.array([p for t in terms for p in postings[t]], dtype=np.int64).reshape(-1, 2)
+
+    return (terms, dfs, flat[:, 0].astype(np.int32), flat[:, 1].astype(np.int32),
+            np.array(doc_lengths, dtype=np.uint32), skipped_lines)
+
+
+def _shard_terms(shard_no, terms):
+    for i, term in enumerate(terms):
+        yield term.encode("utf-8"), shard_no, i, term
+
+
+def _concat_postings(term, parts):
+    return (term,
+            np.concatenate([doc_ids for doc_ids, _ in parts]),
+            np.concatenate([tfs for _, tfs in parts]))
+
+
+def build_index_parallel(language, corpus_path, postings_path, workers=NUM_WORKERS):
+    """
+    Multi-process version of build_index that writes postings.bin directly.
+
+    The corpus is cut into byte-range shards (about 4 per worker so a slow
+    shard does not hold up the pool), every shard is inverted in its own
+    process, and the sorted partial indexes are k-way merged by term into
+    the final postings file. Shards are merged in corpus order, so doc ids
+    and postings come out exactly as from the sequential build.
+
+    Returns (doc_lengths, stats) like build_index.
+    """
+    shards = shard_offsets(corpus_path, workers * 4)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        partials = list(pool.map(
+            index_shard,
+            [language] * len(shards), [corpus_path] * len(shards),
+            [a for a, _ in shards], [b for _, b in shards],
+        ))
+
+    lengths = np.concatenate([p[4] for p in partials]) if partials else np.zeros(0, np.uint32)
+    doc_bases = np.cumsum([0] + [len(p[4]) for p in partials])
+    row_starts = [np.cumsum(p[1]) - p[1] for p in partials]
+
+    vocabulary_size = 0
+
+    def merged_postings():
+        nonlocal vocabulary_size
+        streams = [_shard_terms(n, p[0]) for n, p in enumerate(partials)]
+        current, parts = None, []
+        for raw, n, i, term in heapq.merge(*streams):
+            if current is None or raw != current[0]:
+                if parts:
+                    vocabulary_size += 1
+                    yield _concat_postings(current[1], parts)
+                current, parts = (raw, term), []
+            start, df = row_starts[n][i], partials[n][1][i]
+            parts.append((partials[n][2][start:start + df] + doc_bases[n],
+                          partials[n][3][start:start + df]))
+        if parts:
+            vocabulary_size += 1
+            yield _concat_postings(current[1], parts)
+
+    write_sorted_postings(postings_path, merged_postings(), lengths,
+                          impact_bits=IMPACT_BITS, k1=BM25_K1, b=BM25_B)
+
+    total_docs = len(lengths)
+    doc_lengths = {str(doc_id): int(length) for doc_id, length in enumerate(lengths)}
+    stats = {
+        "language": language,
+        "total_documents": total_docs,
+        "corpus_bytes": shards[-1][1] if shards else 0,
+        "skipped_lines": sum(p[5] for p in partials),
+        "vocabulary_size": vocabulary_size,
+        "average_doc_length": (
+            float(lengths.sum()) / total_docs if total_docs > 0 else 0
+        )
+    }
+
+    return doc_lengths, stats
+
+
+# ===============================
+# BOUNDED-MEMORY BUILD (SPIMI)
+# ===============================
+
+# per run entry: UTF-8 term length, df; then the term and df (doc id, tf)
+# uint32 pairs
+RUN_ENTRY = struct.Struct("<II")
+
+# rough CPython cost of one new term in the in-memory block (dict slot,
+# str object, array object), on top of its UTF-8 bytes
+TERM_OVERHEAD_BYTES = 200
+
+
+def _write_run(block, path):
+    """Flush an in-memory block (term -> array of doc, tf pairs) as a sorted run."""
+    with open(path, "wb") as f:
+        for raw, term in sorted((term.encode("utf-8"), term) for term in block):
+            pairs = block[term]
+            f.write(RUN_ENTRY.pack(len(raw), len(pairs) // 2))
+            f.write(raw)
+            f.write(pairs.tobytes())
+
+
+def _read_run(path, run_no):
+    """Stream a run back as (term bytes, run_no, (df, 2) uint32 array) entries."""
+    with open(path, "rb", buffering=1 << 20) as f:
+        while True:
+            entry = f.read(RUN_ENTRY.size)
+            if not entry:
+                break
+            term_len, df = RUN_ENTRY.unpack(entry)
+            raw = f.read(term_len)
+            pairs = np.frombuffer(f.read(8 * df), dtype=np.uint32).reshape(df, 2)
+            yield raw, run_no, pairs
+
+
+def _write_doc_lengths_json(path, lengths):
+    """doc_lengths.json in the same layout as json.dump(..., indent=2), streamed."""
+    with open(path, "w", encoding="utf-8") as f:
+        if not len(lengths):
+            f.write("{}")
+            return
+        f.write("{")
+        for start in range(0, len(lengths), 1 << 16):
+            chunk = lengths[start:start + (1 << 16)]
+            f.write(",".join(f'\n  "{start + i}": {int(n)}' for i, n in enumerate(chunk)))
+            if start + len(chunk) < len(lengths):
+                f.write(",")
+        f.write("\n}")
+
+
+def build_index_spimi(language, corpus_path, postings_path, doc_lengths_path,
+                      memory_budget_mb=MEMORY_BUDGET_MB, run_dir=None):
+    """
+    Single-pass in-memory inversion (SPIMI) with a fixed memory budget.
+
+    Documents are inverted into an in-memory block; when the block's
+    estimated size reaches the budget it is written to disk as a run
+    sorted by term and the block starts over. Doc lengths go straight to
+    a uint32 file. At the end the runs are k-way merged term by term into
+    postings.bin, with the writer spooling its sections to disk as well.
+
+    Peak memory is the budget plus one read buffer per run plus the
+    largest single posting list, independent of corpus size. Doc ids and
+    postings are the same as build_index's.
+
+    Writes postings.bin and doc_lengths.json; returns stats like build_index.
+    """
+    budget = int(memory_budget_mb * 2**20)
+    work_dir = tempfile.mkdtemp(prefix="spimi-", dir=run_dir or os.path.dirname(postings_path))
+
+    try:
+        runs = []
+        block = {}
+        block_bytes = 0
+        total_docs = 0
+        total_length = 0
+        skipped_lines = 0
+
+        lengths_path = os.path.join(work_dir, "doc_lengths.u32")
+        lengths_buf = array("I")
+
+        with open(corpus_path, "rb") as f, open(lengths_path, "wb") as lengths_out:
+            for line_no, raw in enumerate(f, start=1):
+                line = raw.decode("utf-8").strip()
+
+                if not line:
+                    continue
+
+                try:
+                    doc = json.loads(line)
+                except json.JSONDecodeError as e:
+                    skipped_lines += 1
+                    print(f"[WARN] Skipping bad JSON at line {line_no}: {e}")
+                    continue
+
+                tokens = tokenize(doc.get("body", ""), language)
+
+                doc_id = total_docs
+                total_docs += 1
+                total_length += len(tokens)
+                lengths_buf.append(len(tokens))
+                if len(lengths_buf) >= 1 << 16:
+                    lengths_buf.tofile(lengths_out)
+                    lengths_buf = array("I")
+
+                for term, freq in Counter(tokens).items():
+                    pairs = block.get(term)
+                    if pairs is None:
+                        pairs = block[term] = array("I")
+                        block_bytes += TERM_OVERHEAD_BYTES + len(term)
+                    pairs.append(doc_id)
+                    pairs.append(freq)
+                    block_bytes += 8
+
+                if block_bytes >= budget:
+                    runs.append(os.path.join(work_dir, f"run_{len(runs):05d}.bin"))
+                    _write_run(block, runs[-1])
+                    block, block_bytes = {}, 0
+
+            corpus_bytes = f.tell()
+            lengths_buf.tofile(lengths_out)
+
+        if block:
+            runs.append(os.path.join(work_dir, f"run_{len(runs):05d}.bin"))
+            _write_run(block, runs[-1])
+        del block
+
+        lengths = (np.memmap(lengths_path, dtype=np.uint32, mode="r")
+                   if total_docs else np.zeros(0, dtype=np.uint32))
+
+        vocabulary_size = 0
+
+        def merged_postings():
+            nonlocal vocabulary_size
+            streams = [_read_run(path, run_no) for run_no, path in enumerate(runs)]
+            current, parts = None, []
+            # runs cover increasing doc ids, so concatenating a term's
+            # parts in run order keeps its postings sorted
+            for raw, _, pairs in heapq.merge(*streams, key=lambda entry: entry[:2]):
+                if raw != current:
+                    if parts:
+                        vocabulary_size += 1
+                        yield _concat_postings(current.decode("utf-8"), parts)
+                    current, parts = raw, []
+                parts.append((pairs[:, 0], pairs[:, 1]))
+            if parts:
+                vocabulary_size += 1
+                yield _concat_postings(current.decode("utf-8"), parts)
+
+        write_sorted_postings(postings_path, merged_postings(), lengths,
+                              impact_bits=IMPACT_BITS, k1=BM25_K1, b=BM25_B,
+                              spool_dir=work_dir)
+        _write_doc_lengths_json(doc_lengths_path, lengths)
+        del lengths
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        "language": language,
+        "total_documents": total_docs,
+        "corpus_bytes": corpus_bytes,
+        "skipped_lines": skipped_lines,
+        "vocabulary_size": vocabulary_size,
+        "average_doc_length": (
+            total_length / total_docs if total_docs > 0 else 0
+        ),
+        "spill_runs": len(runs),
+    }
+
+
+def peak_rss_mb():
+    """
+    Peak resident memory in MB as (this process, largest child process),
+    or None where it cannot be measured.
+    """
+    try:
+        import resource
+    except ImportError:  # Windows
+        try:
+            import psutil
+        except ImportError:
+            return None
+        return psutil.Process().memory_info().peak_wset / 2**20, None
+
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    unit = 2**20 if sys.platform == "darwin" else 2**10
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / unit)
+
 
 # ===============================
 # RUN FOR BOTH LANGUAGES
 # ===============================
-for language, path in CORPORA.items():
-    print(f"Building index for {language}...")
+if __name__ == "__main__":
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+
+    for language, path in CORPORA.items():
+        lang_dir = os.path.join(OUTPUT_DIR, language)
+
+        if INCREMENTAL and os.path.exists(os.path.join(lang_dir, MANIFEST_FILENAME)):
+            print(f"Updating index for {language}...")
+            merger = SegmentMerger(lang_dir, impact_bits=IMPACT_BITS, k1=BM25_K1, b=BM25_B)
+
+            start = time.perf_counter()
+            first_id, added = update_from_jsonl(
+                lang_dir, path,
+                lambda doc: tokenize(doc.get("body", ""), language),
+                merger=merger
+            )
+            elapsed_ms = (time.perf_counter() - start) * 1000
+
+            merger.join()
+            print(f"✓ {language}: {added} new docs (ids from {first_id}) indexed in {elapsed_ms:.1f} ms")
+            continue
+
+        print(f"Building index for {language}...")
+        os.makedirs(lang_dir, exist_ok=True)
+        postings_path = os.path.join(lang_dir, POSTINGS_FILENAME)
+
+        start = time.perf_counter()
+        if MEMORY_BUDGET_MB and not WRITE_JSON_INDEX:
+            # writes doc_lengths.json itself, streamed
+            doc_lengths = None
+            stats = build_index_spimi(
+                language, path, postings_path,
+                os.path.join(lang_dir, "doc_lengths.json"), MEMORY_BUDGET_MB
+            )
+        elif NUM_WORKERS > 1 and not WRITE_JSON_INDEX:
+            doc_lengths, stats = build_index_parallel(language, path, postings_path, NUM_WORKERS)
+        else:
+            inv_index, doc_lengths, stats = build_index(language, path)
+            write_postings(
+                postings_path, inv_index, doc_lengths,
+                impact_bits=IMPACT_BITS, k1=BM25_K1, b=BM25_B
+            )
+        elapsed = time.perf_counter() - start
 
-    inv_index, doc_lengths, stats = build_index(language, path)
+        rss = peak_rss_mb()
+        print(f"  {stats['total_documents'] / elapsed:.0f} docs/sec "
+              f"({stats['total_documents']} docs in {elapsed:.1f}s)")
+        if rss is not None:
+            print(f"  peak RSS: {rss[0]:.0f} MB main"
+                  + (f", {rss[1]:.0f} MB largest worker" if rss[1] else ""))
 
-    lang_dir = os.path.join(OUTPUT_DIR, language)
-    os.makedirs(lang_dir, exist_ok=True)
+        init_segments(lang_dir, corpus_offset=stats["corpus_bytes"])
 
-    with open(os.path.join(lang_dir, "inverted_index.json"), "w", encoding="utf-8") as f:
-        json.dump(inv_index, f, ensure_ascii=False, indent=2)
+        if WRITE_JSON_INDEX:
+            with open(os.path.join(lang_dir, "inverted_index.json"), "w", encoding="utf-8") as f:
+                json.dump(inv_index, f, ensure_ascii=False, indent=2)
 
-    with open(os.path.join(lang_dir, "doc_lengths.json"), "w", encoding="utf-8") as f:
-        json.dump(doc_lengths, f, indent=2)
+        if doc_lengths is not None:
+            with open(os.path.join(lang_dir, "doc_lengths.json"), "w", encoding="utf-8") as f:
+                json.dump(doc_lengths, f, indent=2)
 
-    with open(os.path.join(lang_dir, "stats.json"), "w", encoding="utf-8") as f:
-        json.dump(stats, f, indent=2)
+        with open(os.path.join(lang_dir, "stats.json"), "w", encoding="utf-8") as f:
+            json.dump(stats, f, indent=2)
 
-    print(f"✓ {language} index built")
-    print(stats)
+        print(f"✓ {language} index built")
+        print(stats)
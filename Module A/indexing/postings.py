@@ -0,0 +1,515 @@
+import io
+import math
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+
+import numpy as np
+
+# ===============================
+# FILE LAYOUT
+# ===============================
+#
+#   header       fixed-size struct (see HEADER_FORMAT)
+#   term table   one TERM_DTYPE record per term, sorted by UTF-8 bytes
+#   term bytes   concatenated UTF-8 encoded terms
+#   doc ids      per term: delta-encoded doc ids, LEB128 varints
+#   tfs          per term: term frequencies as a flat uint16/uint32 array
+#   doc lengths  uint32 array, one entry per doc id
+#   impacts      optional (v2): quantized BM25 impact per posting,
+#                uint8/uint16, aligned with the tf array
+#
+# Every section starts on an 8-byte boundary so numpy can view it
+# straight out of the mmap without copying.
+
+MAGIC = b"CLIRPST1"
+VERSION = 2
+POSTINGS_FILENAME = "postings.bin"
+
+# elements per chunk when the writer streams spooled sections to the file
+SPOOL_CHUNK = 1 << 16
+
+# v1 header, followed in v2 by IMPACT_FORMAT:
+#   impact_bits (0 = no impacts), k1, b, impact_scale, impacts_off
+HEADER_FORMAT = "<8sIIIIQQQQQQQ"
+IMPACT_FORMAT = "<IdddQ"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT) + struct.calcsize(IMPACT_FORMAT)
+
+TERM_DTYPE = np.dtype([
+    ("term_off", "<u8"),   # byte offset into the term bytes section
+    ("term_len", "<u4"),   # length of the UTF-8 term in bytes
+    ("df", "<u4"),         # document frequency
+    ("docs_off", "<u8"),   # byte offset into the doc id section
+    ("docs_len", "<u8"),   # number of varint bytes for this term
+    ("tf_off", "<u8"),     # element offset into the tf array
+])
+
+
+def _align(offset, alignment=8):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+# ===============================
+# VARINT CODEC
+# ===============================
+def encode_varints(values):
+    """
+    LEB128-encode a sequence of non-negative ints (7 bits per byte,
+    high bit set on every byte except the last one of a value).
+
+    Vectorized like decode_varints: one numpy pass per byte position,
+    so writing postings is not bound by a per-posting Python loop.
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    if values.size == 0:
+        return b""
+
+    # bytes needed per value: 1 + number of 7-bit groups above the first
+    nbytes = np.ones(values.size, dtype=np.int64)
+    rest = values >> np.uint64(7)
+    while rest.any():
+        nbytes += rest > 0
+        rest >>= np.uint64(7)
+
+    starts = np.cumsum(nbytes) - nbytes
+    out = np.empty(int(nbytes.sum()), dtype=np.uint8)
+    for k in range(int(nbytes.max())):
+        sel = np.flatnonzero(nbytes > k)
+        chunk = (values[sel] >> np.uint64(7 * k)) & np.uint64(0x7F)
+        more = (nbytes[sel] > k + 1).astype(np.uint64) << np.uint64(7)
+        out[starts[sel] + k] = chunk | more
+    return out.tobytes()
+
+
+def decode_varints(buf):
+    """
+    Vectorized LEB128 decode of a uint8 array into a uint64 array.
+    """
+    buf = np.asarray(buf, dtype=np.uint8)
+    if buf.size == 0:
+        return np.zeros(0, dtype=np.uint64)
+
+    ends = np.flatnonzero(buf < 0x80)
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+
+    # position of every byte inside its own varint -> shift amount
+    group = np.repeat(np.arange(ends.size), ends - starts + 1)
+    shifts = (np.arange(buf.size) - starts[group]).astype(np.uint64) * np.uint64(7)
+
+    payload = (buf & 0x7F).astype(np.uint64) << shifts
+    return np.add.reduceat(payload, starts)
+
+
+# ===============================
+# WRITER
+# ===============================
+def bm25_impacts(tfs, dls, df, N, avgdl, k1, b):
+    """
+    BM25 contribution of one term to each of its postings:
+        idf * tf*(k1+1) / (tf + k1*(1 - b + b*dl/avgdl))
+    """
+    tfs = np.asarray(tfs, dtype=np.float64)
+    idf = np.log((N - df + 0.5) / (df + 0.5) + 1.0)
+    denom = tfs + k1 * (1.0 - b + b * (np.asarray(dls, dtype=np.float64) / (avgdl + 1e-9)))
+    return idf * (tfs * (k1 + 1.0)) / denom
+
+
+def _impact_scale(max_impact, bits):
+    levels = (1 << bits) - 1
+    return max_impact / levels if max_impact > 0 else 1.0
+
+
+def quantize_impacts(impacts, bits, scale=None):
+    """
+    Linear quantization onto [1, 2**bits - 1]; returns (codes, scale) with
+    impact ~= code * scale. Every posting keeps a non-zero code so a
+    matching document never drops out of the result set.
+
+    scale defaults to max(impacts) / (2**bits - 1); pass it explicitly to
+    quantize an array chunk by chunk.
+    """
+    dtype = {8: np.uint8, 16: np.uint16}[bits]
+    levels = (1 << bits) - 1
+    if scale is None:
+        scale = _impact_scale(float(impacts.max()) if impacts.size else 0.0, bits)
+    codes = np.clip(np.rint(impacts / scale), 1, levels).astype(dtype)
+    return codes, scale
+
+
+def write_postings(path, inverted_index, doc_lengths,
+                   impact_bits=None, k1=1.5, b=0.75):
+    """
+    Serialize an in-memory index to the binary postings format.
+
+    inverted_index: dict term -> {doc_id: tf}   (doc ids may be str or int)
+    doc_lengths:    dict doc_id -> length, or a list indexed by doc id
+    impact_bits:    8 or 16 to also store quantized BM25 impacts computed
+                    with (k1, b); None to skip them
+    """
+    if isinstance(doc_lengths, dict):
+        lengths = np.zeros(len(doc_lengths), dtype=np.uint32)
+        for doc_id, length in doc_lengths.items():
+            lengths[int(doc_id)] = length
+    else:
+        lengths = doc_lengths
+
+    def sorted_postings():
+        for term in sorted(inverted_index, key=lambda t: t.encode("utf-8")):
+            postings = inverted_index[term]
+            doc_ids = np.fromiter((int(d) for d in postings), dtype=np.int64, count=len(postings))
+            tfs = np.fromiter(postings.values(), dtype=np.int64, count=len(postings))
+            order = np.argsort(doc_ids, kind="stable")
+            yield term, doc_ids[order], tfs[order]
+
+    write_sorted_postings(path, sorted_postings(), lengths,
+                          impact_bits=impact_bits, k1=k1, b=b)
+
+
+def write_sorted_postings(path, postings, doc_lengths,
+                          impact_bits=None, k1=1.5, b=0.75, spool_dir=None):
+    """
+    Streaming writer behind write_postings, for callers that already
+    produce postings in order (segment merges, run merges).
+
+    postings:    iterable of (term, doc_ids, tfs), terms in UTF-8 byte
+                 order and doc ids ascending within each term
+    doc_lengths: array-like indexed by doc id (an np.memmap works)
+    spool_dir:   if set, the sections are buffered in temporary files
+                 there instead of in memory, so writing needs memory only
+                 for the posting list at hand
+    """
+    if impact_bits not in (None, 8, 16):
+        raise ValueError(f"impact_bits must be None, 8 or 16, got {impact_bits!r}")
+
+    lengths = np.asarray(doc_lengths, dtype=np.uint32)
+
+    def spool():
+        return tempfile.TemporaryFile(dir=spool_dir) if spool_dir else io.BytesIO()
+
+    table_out, terms_out, docs_out, tfs_out, impacts_out = (spool() for _ in range(5))
+    records = []
+    num_terms = 0
+    term_bytes = doc_bytes = 0
+    tf_total = 0
+    max_tf = 0
+    max_impact = 0.0
+
+    N = len(lengths)
+    total_length = int(lengths.sum(dtype=np.uint64))
+    avgdl = total_length / N if N > 0 else 0.0
+
+    for term, doc_ids, tfs in postings:
+        raw = term.encode("utf-8")
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        tfs = np.asarray(tfs)
+        deltas = np.diff(doc_ids, prepend=0)
+        encoded = encode_varints(deltas)
+
+        records.append((term_bytes, len(raw), len(doc_ids),
+                        doc_bytes, len(encoded), tf_total))
+        if len(records) >= SPOOL_CHUNK:
+            table_out.write(np.array(records, dtype=TERM_DTYPE).tobytes())
+            records = []
+        num_terms += 1
+
+        terms_out.write(raw)
+        docs_out.write(encoded)
+        tfs_out.write(tfs.astype(np.uint32).tobytes())
+        term_bytes += len(raw)
+        doc_bytes += len(encoded)
+        if impact_bits:
+            impacts = bm25_impacts(tfs, lengths[doc_ids], len(doc_ids), N, avgdl, k1, b)
+            impacts_out.write(impacts.tobytes())
+            if impacts.size:
+                max_impact = max(max_impact, float(impacts.max()))
+        tf_total += len(tfs)
+        if len(tfs):
+            max_tf = max(max_tf, int(tfs.max()))
+
+    table_out.write(np.array(records, dtype=TERM_DTYPE).tobytes())
+
+    tf_dtype = np.uint16 if max_tf <= np.iinfo(np.uint16).max else np.uint32
+    impact_scale = _impact_scale(max_impact, impact_bits) if impact_bits else 0.0
+
+    table_off = _align(HEADER_SIZE)
+    terms_off = _align(table_off + num_terms * TERM_DTYPE.itemsize)
+    docs_off = _align(terms_off + term_bytes)
+    tfs_off = _align(docs_off + doc_bytes)
+    lengths_off = _align(tfs_off + tf_total * np.dtype(tf_dtype).itemsize)
+    impacts_off = _align(lengths_off + lengths.nbytes)
+
+    header = struct.pack(
+        HEADER_FORMAT,
+        MAGIC,
+        VERSION,
+        num_terms,
+        N,
+        np.dtype(tf_dtype).itemsize,
+        total_length,
+        tf_total,
+        table_off,
+        terms_off,
+        docs_off,
+        tfs_off,
+        lengths_off,
+    ) + struct.pack(
+        IMPACT_FORMAT,
+        impact_bits or 0,
+        k1 if impact_bits else 0.0,
+        b if impact_bits else 0.0,
+        impact_scale,
+        impacts_off if impact_bits else 0,
+    )
+
+    def pad_to(f, offset):
+        f.write(b"\0" * (offset - f.tell()))
+
+    def copy_spooled(f, src, dtype=None, convert=None):
+        src.seek(0)
+        if convert is None:
+            shutil.copyfileobj(src, f)
+            return
+        # re-encode a spooled array chunk by chunk
+        step = SPOOL_CHUNK * np.dtype(dtype).itemsize
+        while True:
+            chunk = src.read(step)
+            if not chunk:
+                break
+            f.write(convert(np.frombuffer(chunk, dtype=dtype)).tobytes())
+
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(header)
+            pad_to(f, table_off)
+            copy_spooled(f, table_out)
+            pad_to(f, terms_off)
+            copy_spooled(f, terms_out)
+            pad_to(f, docs_off)
+            copy_spooled(f, docs_out)
+            pad_to(f, tfs_off)
+            copy_spooled(f, tfs_out, np.uint32, lambda a: a.astype(tf_dtype))
+            pad_to(f, lengths_off)
+            for start in range(0, N, SPOOL_CHUNK):
+                f.write(np.ascontiguousarray(lengths[start:start + SPOOL_CHUNK]).tobytes())
+            pad_to(f, impacts_off)
+            if impact_bits:
+                copy_spooled(f, impacts_out, np.float64,
+                             lambda a: quantize_impacts(a, impact_bits, impact_scale)[0])
+    finally:
+        for spooled in (table_out, terms_out, docs_out, tfs_out, impacts_out):
+            spooled.close()
+    os.replace(tmp_path, path)
+
+
+# ===============================
+# MMAP READER
+# ===============================
+class PostingsIndex:
+    """
+    Read-only view over a postings.bin file.
+
+    Opening is O(1) in corpus size: the file is mmapped and every section
+    is exposed as a zero-copy numpy view, so only the pages touched by a
+    query are ever read from disk.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, version, num_terms, num_docs, tf_size, total_length,
+         num_postings, table_off, terms_off, docs_off, tfs_off, lengths_off) = \
+            struct.unpack_from(HEADER_FORMAT, self._mm, 0)
+
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a postings file (bad magic {magic!r})")
+        if version not in (1, VERSION):
+            raise ValueError(f"{path} has unsupported version {version}")
+
+        impact_bits, k1, b, impact_scale, impacts_off = 0, 0.0, 0.0, 0.0, 0
+        if version >= 2:
+            impact_bits, k1, b, impact_scale, impacts_off = struct.unpack_from(
+                IMPACT_FORMAT, self._mm, struct.calcsize(HEADER_FORMAT))
+
+        tf_dtype = np.uint16 if tf_size == 2 else np.uint32
+
+        self.num_terms = num_terms
+        self.N = num_docs
+        self.avgdl = total_length / num_docs if num_docs > 0 else 0.0
+
+        self._table = np.frombuffer(self._mm, TERM_DTYPE, num_terms, table_off)
+        self._terms = memoryview(self._mm)[terms_off:docs_off]
+        self._docs = np.frombuffer(self._mm, np.uint8, tfs_off - docs_off, docs_off)
+        self._tfs = np.frombuffer(self._mm, tf_dtype, num_postings, tfs_off)
+        self.doc_lengths = np.frombuffer(self._mm, np.uint32, num_docs, lengths_off)
+        self._doc_lengths_f32 = None
+
+        # quantized BM25 impacts, only when the index was built with them
+        self.impact_bits = impact_bits
+        self.impact_params = (k1, b) if impact_bits else None
+        self.impact_scale = impact_scale
+        self._impacts = None
+        if impact_bits:
+            impact_dtype = np.uint8 if impact_bits == 8 else np.uint16
+            self._impacts = np.frombuffer(self._mm, impact_dtype, num_postings, impacts_off)
+
+    @property
+    def has_impacts(self):
+        return self._impacts is not None
+
+    def check_impact_params(self, k1, b):
+        """Raise if the stored impacts were computed with different BM25 parameters."""
+        if not self.has_impacts:
+            raise ValueError(f"{self.path} was built without impact scores")
+        if not (math.isclose(self.impact_params[0], k1) and math.isclose(self.impact_params[1], b)):
+            raise ValueError(
+                f"{self.path} stores BM25 impacts for k1={self.impact_params[0]}, "
+                f"b={self.impact_params[1]}, but k1={k1}, b={b} was requested; "
+                f"rebuild the index with the new parameters"
+            )
+
+    @property
+    def doc_lengths_f32(self):
+        """Dense float32 copy of the doc lengths, built on first use."""
+        if self._doc_lengths_f32 is None:
+            self._doc_lengths_f32 = self.doc_lengths.astype(np.float32)
+        return self._doc_lengths_f32
+
+    # -------------------------------
+    # term dictionary
+    # -------------------------------
+    def _term_at(self, slot):
+        rec = self._table[slot]
+        start = int(rec["term_off"])
+        return bytes(self._terms[start:start + int(rec["term_len"])])
+
+    def lookup(self, term):
+        """Binary search the sorted term table; returns the slot or -1."""
+        key = term.encode("utf-8")
+        lo, hi = 0, self.num_terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._term_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.num_terms and self._term_at(lo) == key:
+            return lo
+        return -1
+
+    def __contains__(self, term):
+        return self.lookup(term) >= 0
+
+    def __len__(self):
+        return self.num_terms
+
+    def terms(self):
+        for slot in range(self.num_terms):
+            yield self._term_at(slot).decode("utf-8")
+
+    def items(self):
+        """Yield (term, doc_ids, tfs) for every term, in file (UTF-8) order."""
+        for slot in range(self.num_terms):
+            doc_ids, tfs = self.postings_at(slot)
+            yield self._term_at(slot).decode("utf-8"), doc_ids, tfs
+
+    def df(self, term):
+        slot = self.lookup(term)
+        return int(self._table[slot]["df"]) if slot >= 0 else 0
+
+    def df_at(self, slots):
+        return self._table["df"][np.asarray(slots, dtype=np.int64)].astype(np.int64)
+
+    # -------------------------------
+    # postings
+    # -------------------------------
+    def postings_at(self, slot):
+        rec = self._table[slot]
+        start = int(rec["docs_off"])
+        deltas = decode_varints(self._docs[start:start + int(rec["docs_len"])])
+        doc_ids = np.cumsum(deltas).astype(np.int64)
+
+        tf_start = int(rec["tf_off"])
+        tfs = self._tfs[tf_start:tf_start + int(rec["df"])]
+        return doc_ids, tfs
+
+    def postings(self, term):
+        """
+        Returns (doc_ids, tfs) as numpy arrays, or None for unknown terms.
+        """
+        slot = self.lookup(term)
+        if slot < 0:
+            return None
+        return self.postings_at(slot)
+
+    def postings_many(self, slots):
+        """
+        Decode the postings of several terms in one vectorized pass.
+
+        Returns (term_pos, doc_ids, tfs): three aligned flat arrays, where
+        term_pos[i] is the position in `slots` the i-th posting belongs to.
+        This is the CSR row-gather the query-time scorers are built on.
+        """
+        recs = self._table[np.asarray(slots, dtype=np.int64)]
+        dfs = recs["df"].astype(np.int64)
+
+        raw = np.concatenate([
+            self._docs[int(r["docs_off"]):int(r["docs_off"]) + int(r["docs_len"])]
+            for r in recs
+        ]) if len(recs) else np.zeros(0, dtype=np.uint8)
+        tfs = self._gather_flat(self._tfs, recs)
+
+        term_pos = np.repeat(np.arange(len(recs)), dfs)
+
+        # segmented prefix sum: every row restarts from its own first delta
+        totals = np.cumsum(decode_varints(raw).astype(np.int64))
+        row_starts = np.cumsum(dfs) - dfs
+        base = np.zeros(len(recs), dtype=np.int64)
+        has_prev = (row_starts > 0) & (dfs > 0)
+        base[has_prev] = totals[row_starts[has_prev] - 1]
+        doc_ids = totals - base[term_pos]
+
+        return term_pos, doc_ids, tfs
+
+    def impacts_many(self, slots):
+        """Quantized impacts aligned with postings_many(slots)."""
+        if not self.has_impacts:
+            raise ValueError(f"{self.path} was built without impact scores")
+        return self._gather_flat(self._impacts, self._table[np.asarray(slots, dtype=np.int64)])
+
+    @staticmethod
+    def _gather_flat(array, recs):
+        """Concatenate the per-term slices of a flat per-posting array."""
+        if not len(recs):
+            return np.zeros(0, dtype=array.dtype)
+        return np.concatenate([
+            array[int(r["tf_off"]):int(r["tf_off"]) + int(r["df"])]
+            for r in recs
+        ])
+
+    # -------------------------------
+    # lifecycle
+    # -------------------------------
+    def close(self):
+        # drop the numpy views first, mmap refuses to close while exported
+        self._table = self._docs = self._tfs = self.doc_lengths = self._impacts = None
+        self._terms.release()
+        try:
+            self._mm.close()
+        except BufferError:
+            # a caller still holds a postings view; the mapping goes away
+            # once that array is garbage-collected
+            pass
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
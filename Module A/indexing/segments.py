@@ -0,0 +1,549 @@
+import heapq
+import json
+import os
+import threading
+from collections import Counter
+
+import numpy as np
+
+from postings import POSTINGS_FILENAME, PostingsIndex, write_sorted_postings
+
+# ===============================
+# LAYOUT
+# ===============================
+#
+#   index/<lang>/postings.bin     base segment written by a full build
+#   index/<lang>/seg_000001.bin   append-only segments for new documents
+#   index/<lang>/segments.json    manifest: live segments in doc id order
+#
+# Every segment is a regular postings.bin file with local doc ids
+# 0..num_docs-1; its global doc ids start at "doc_base". Segments cover
+# consecutive doc id ranges, so a term's postings across segments are
+# just the per-segment lists shifted and concatenated.
+#
+# Writers publish a new manifest with os.replace, so readers never see a
+# half-written state. One writer process per index directory. Files merged
+# away that could not be deleted yet (still mapped by a reader on Windows)
+# are listed under "pending_delete" and retried after every merge.
+
+MANIFEST_FILENAME = "segments.json"
+
+# Number of neighbouring segments combined by one merge (see pick_merge).
+MERGE_FACTOR = 10
+
+# A merger with impacts configured optimizes the whole index (rewriting it
+# with impacts) once documents in segments without impacts make up this
+# share of it; until then bm25_impact falls back to query-time BM25.
+OPTIMIZE_SHARE = 0.1
+
+
+def _manifest_path(index_dir):
+    return os.path.join(index_dir, MANIFEST_FILENAME)
+
+
+def read_manifest(index_dir):
+    """
+    Load segments.json. An index with only a postings.bin (full build,
+    no manifest yet) is treated as a single base segment.
+    """
+    path = _manifest_path(index_dir)
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    if not os.path.exists(os.path.join(index_dir, POSTINGS_FILENAME)):
+        raise FileNotFoundError(f"no {POSTINGS_FILENAME} or {MANIFEST_FILENAME} in {index_dir}")
+    return _base_manifest(index_dir)
+
+
+def _base_manifest(index_dir):
+    with PostingsIndex(os.path.join(index_dir, POSTINGS_FILENAME)) as index:
+        num_docs, impacts = index.N, index.has_impacts
+    return {
+        "next_segment": 1,
+        "corpus_offset": None,
+        "segments": [{"name": POSTINGS_FILENAME, "doc_base": 0, "num_docs": num_docs, "impacts": impacts}],
+    }
+
+
+def write_manifest(index_dir, manifest):
+    path = _manifest_path(index_dir)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def init_segments(index_dir, corpus_offset=None):
+    """
+    Start a fresh manifest after a full build wrote postings.bin, dropping
+    any segments left over from earlier incremental updates.
+
+    corpus_offset: bytes of the corpus JSONL covered by the build, so a
+                   later update only has to read what was appended after it
+    """
+    old = _manifest_path(index_dir)
+    stale = []
+    if os.path.exists(old):
+        with open(old, "r", encoding="utf-8") as f:
+            old_manifest = json.load(f)
+        stale = [s["name"] for s in old_manifest["segments"] if s["name"] != POSTINGS_FILENAME]
+        stale += [name for name in old_manifest.get("pending_delete", []) if name != POSTINGS_FILENAME]
+
+    manifest = _base_manifest(index_dir)
+    manifest["corpus_offset"] = corpus_offset
+    write_manifest(index_dir, manifest)
+
+    pending = _remove_files(index_dir, stale)
+    if pending:
+        manifest["pending_delete"] = pending
+        write_manifest(index_dir, manifest)
+    return manifest
+
+
+def _remove_files(index_dir, names):
+    """Delete files that left the manifest; returns the names that could not be deleted yet."""
+    pending = []
+    for name in names:
+        try:
+            os.remove(os.path.join(index_dir, name))
+        except FileNotFoundError:
+            pass
+        except OSError:
+            # still mapped by a reader (Windows); retried after the next merge
+            pending.append(name)
+    return pending
+
+
+def _release_files(index_dir, names):
+    """
+    Delete segment files merged away, plus those left pending by earlier
+    merges. Whatever is still in use stays in the manifest's pending_delete.
+    """
+    with _manifest_lock:
+        manifest = read_manifest(index_dir)
+        retry = manifest.get("pending_delete", [])
+        pending = _remove_files(index_dir, retry + list(names))
+        if pending != retry:
+            manifest["pending_delete"] = pending
+            write_manifest(index_dir, manifest)
+
+
+# ===============================
+# WRITER
+# ===============================
+
+# serializes manifest updates between add_segment() and background merges
+_manifest_lock = threading.Lock()
+
+
+def add_segment(index_dir, docs_tokens, corpus_offset=None, merger=None):
+    """
+    Index a batch of new documents as one append-only segment.
+
+    Only the new documents are touched: cost is proportional to the batch,
+    not to the corpus. Global doc ids continue from the last segment.
+
+    docs_tokens:   list of token lists, one per new document, in doc id order
+    corpus_offset: new end offset in the corpus JSONL (for update_from_jsonl)
+    merger:        optional SegmentMerger to notify once the segment is live
+
+    Returns the global doc id of the first new document.
+    """
+    inverted_index = {}
+    lengths = np.zeros(len(docs_tokens), dtype=np.uint32)
+    for local_id, tokens in enumerate(docs_tokens):
+        lengths[local_id] = len(tokens)
+        for term, tf in Counter(tokens).items():
+            inverted_index.setdefault(term, ([], []))
+            inverted_index[term][0].append(local_id)
+            inverted_index[term][1].append(tf)
+
+    def sorted_postings():
+        for term in sorted(inverted_index, key=lambda t: t.encode("utf-8")):
+            doc_ids, tfs = inverted_index[term]
+            yield term, np.array(doc_ids, dtype=np.int64), np.array(tfs, dtype=np.int64)
+
+    with _manifest_lock:
+        manifest = read_manifest(index_dir)
+        last = manifest["segments"][-1]
+        doc_base = last["doc_base"] + last["num_docs"]
+
+        if len(docs_tokens):
+            name = f"seg_{manifest['next_segment']:06d}.bin"
+            manifest["next_segment"] += 1
+            write_sorted_postings(os.path.join(index_dir, name), sorted_postings(), lengths)
+            manifest["segments"].append(
+                {"name": name, "doc_base": doc_base, "num_docs": len(docs_tokens), "impacts": False})
+        if corpus_offset is not None:
+            manifest["corpus_offset"] = corpus_offset
+        write_manifest(index_dir, manifest)
+
+    if merger is not None and len(docs_tokens):
+        merger.schedule()
+    return doc_base
+
+
+def update_from_jsonl(index_dir, corpus_path, tokenize_doc, merger=None):
+    """
+    Index whatever was appended to a corpus JSONL since the last build or
+    update, as one new segment.
+
+    tokenize_doc: function doc dict -> token list (same as the full build)
+
+    Returns (first_new_doc_id, number_of_new_docs).
+    """
+    manifest = read_manifest(index_dir)
+    offset = manifest.get("corpus_offset")
+    if offset is None:
+        raise ValueError(
+            f"{index_dir} does not record how much of the corpus it covers; "
+            f"rebuild it once with build_index.py before updating incrementally"
+        )
+
+    docs_tokens = []
+    with open(corpus_path, "rb") as f:
+        f.seek(offset)
+        for raw in f:
+            # a trailing line without newline may still be being written
+            if not raw.endswith(b"\n"):
+                break
+            offset += len(raw)
+            line = raw.decode("utf-8").strip()
+            if not line:
+                continue
+            try:
+                doc = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            docs_tokens.append(tokenize_doc(doc))
+
+    first = add_segment(index_dir, docs_tokens, corpus_offset=offset, merger=merger)
+    return first, len(docs_tokens)
+
+
+# ===============================
+# MERGE POLICY
+# ===============================
+def pick_merge(segments, merge_factor=MERGE_FACTOR):
+    """
+    Pick merge_factor neighbouring segments to merge, or None.
+
+    A window qualifies when no single segment holds more than half of its
+    documents, so every merge at least doubles the size of the segments it
+    rewrites: each document is rewritten O(log N) times in total, and the
+    number of live segments stays logarithmic. Among qualifying windows
+    the smallest (cheapest) is merged first.
+
+    Returns (start, end) indices into segments, or None.
+    """
+    sizes = [s["num_docs"] for s in segments]
+    best, best_total = None, None
+    for start in range(len(segments) - merge_factor + 1):
+        window = sizes[start:start + merge_factor]
+        total = sum(window)
+        if 2 * max(window) <= total and (best is None or total < best_total):
+            best, best_total = start, total
+    if best is None:
+        return None
+    return best, best + merge_factor
+
+
+def merge_segments(index_dir, start, end, impact_bits=None, k1=1.5, b=0.75):
+    """
+    Merge the live segments [start, end) into one new segment and publish it.
+
+    Impacts depend on corpus-wide statistics, so they are only written
+    when the merge covers the whole index (an "optimize"); partial
+    merges store tfs only.
+    """
+    with _manifest_lock:
+        manifest = read_manifest(index_dir)
+        window = manifest["segments"][start:end]
+        covers_all = start == 0 and end >= len(manifest["segments"])
+        # reserve the name now so a concurrent add_segment cannot take it
+        name = f"seg_{manifest['next_segment']:06d}.bin"
+        manifest["next_segment"] += 1
+        write_manifest(index_dir, manifest)
+
+    readers = [PostingsIndex(os.path.join(index_dir, s["name"])) for s in window]
+    try:
+        lengths = np.concatenate([r.doc_lengths for r in readers])
+
+        # k-way merge of the sorted term dictionaries
+        streams = [_keyed_items(seg, r) for seg, r in enumerate(readers)]
+        bases = np.cumsum([0] + [s["num_docs"] for s in window])
+
+        def merged_postings():
+            current, parts = None, []
+            for raw, seg, term, doc_ids, tfs in heapq.merge(*streams, key=lambda x: x[:2]):
+                if raw != current:
+                    if parts:
+                        yield _concat(current, parts)
+                    current, parts = raw, []
+                parts.append((doc_ids + bases[seg], tfs))
+            if parts:
+                yield _concat(current, parts)
+
+        write_sorted_postings(
+            os.path.join(index_dir, name), merged_postings(), lengths,
+            impact_bits=impact_bits if covers_all else None, k1=k1, b=b)
+    finally:
+        for r in readers:
+            r.close()
+
+    with _manifest_lock:
+        manifest = read_manifest(index_dir)
+        names = [s["name"] for s in manifest["segments"]]
+        old = [s["name"] for s in window]
+        # new segments are only ever appended, so the window is still in place
+        i = names.index(old[0])
+        manifest["segments"][i:i + len(old)] = [{
+            "name": name,
+            "doc_base": window[0]["doc_base"],
+            "num_docs": int(sum(s["num_docs"] for s in window)),
+            "impacts": bool(covers_all and impact_bits),
+        }]
+        write_manifest(index_dir, manifest)
+
+    _release_files(index_dir, old)
+    return name
+
+
+def _keyed_items(seg, reader):
+    for term, doc_ids, tfs in reader.items():
+        yield term.encode("utf-8"), seg, term, doc_ids, tfs
+
+
+def _concat(raw, parts):
+    return (raw.decode("utf-8"),
+            np.concatenate([p[0] for p in parts]),
+            np.concatenate([p[1] for p in parts]))
+
+
+class SegmentMerger:
+    """
+    Runs the merge policy on a background thread so add_segment() returns
+    as soon as the new segment is live. Merges repeat until the policy
+    finds nothing left to do. With impact_bits, the index is optimized once
+    segments without impacts hold optimize_share of its documents, so
+    bm25_impact does not stay on its query-time fallback for good.
+    """
+
+    def __init__(self, index_dir, merge_factor=MERGE_FACTOR,
+                 impact_bits=None, k1=1.5, b=0.75, optimize_share=OPTIMIZE_SHARE):
+        self.index_dir = index_dir
+        self.merge_factor = merge_factor
+        self.optimize_share = optimize_share
+        self.impact_params = dict(impact_bits=impact_bits, k1=k1, b=b)
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def schedule(self):
+        self._wakeup.set()
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while self._wakeup.is_set():
+            self._wakeup.clear()
+            while True:
+                segments = read_manifest(self.index_dir)["segments"]
+                picked = pick_merge(segments, self.merge_factor) or self._pick_optimize(segments)
+                if picked is None:
+                    break
+                merge_segments(self.index_dir, *picked, **self.impact_params)
+
+    def _pick_optimize(self, segments):
+        """The whole index, once it is due for an optimize (see OPTIMIZE_SHARE), or None."""
+        if self.impact_params["impact_bits"] is None or len(segments) < 2:
+            return None
+        total = sum(s["num_docs"] for s in segments)
+        without = sum(s["num_docs"] for s in segments if not s.get("impacts"))
+        if without < self.optimize_share * total:
+            return None
+        return 0, len(segments)
+
+    def join(self):
+        """Wait for pending merges (e.g. before a script exits)."""
+        if self._thread is not None:
+            self._thread.join()
+
+    def optimize(self):
+        """Merge everything into a single segment, with impacts if configured."""
+        self.join()
+        segments = read_manifest(self.index_dir)["segments"]
+        if len(segments) > 1:
+            merge_segments(self.index_dir, 0, len(segments), **self.impact_params)
+
+
+# ===============================
+# READER
+# ===============================
+class SegmentedIndex:
+    """
+    Searches all live segments of an index directory as one index.
+
+    Exposes the same interface as PostingsIndex (N, avgdl, doc lengths,
+    lookup / df_at / postings_at / postings_many), so the scorers work on
+    either. Term slots are assigned on first lookup and are only valid
+    until the next refresh().
+    """
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        self._open = {}
+        self.segments = []
+        self.refresh()
+
+    def refresh(self):
+        """Pick up segments added or merged since the index was opened."""
+        manifest = read_manifest(self.index_dir)
+        live = {}
+        for s in manifest["segments"]:
+            reader = self._open.pop(s["name"], None)
+            if reader is None:
+                reader = PostingsIndex(os.path.join(self.index_dir, s["name"]))
+            live[s["name"]] = reader
+        for reader in self._open.values():
+            reader.close()
+        self._open = live
+
+        self.segments = [(s["doc_base"], live[s["name"]]) for s in manifest["segments"]]
+        self.doc_lengths = np.concatenate([r.doc_lengths for _, r in self.segments])
+        self.N = len(self.doc_lengths)
+        self.avgdl = float(self.doc_lengths.sum()) / self.N if self.N > 0 else 0.0
+        self._doc_lengths_f32 = None
+
+        self._slot_of = {}
+        self._local_slots = []   # per global slot: local slot in each segment (-1 = absent)
+        self._df = []
+
+    @property
+    def doc_lengths_f32(self):
+        if self._doc_lengths_f32 is None:
+            self._doc_lengths_f32 = self.doc_lengths.astype(np.float32)
+        return self._doc_lengths_f32
+
+    @property
+    def has_impacts(self):
+        # impacts need corpus-wide stats, so only a fully merged index has them
+        return len(self.segments) == 1 and self.segments[0][1].has_impacts
+
+    def check_impact_params(self, k1, b):
+        if len(self.segments) > 1:
+            raise ValueError(
+                f"{self.index_dir} has {len(self.segments)} segments; BM25 impacts "
+                f"are only available once it is optimized into one"
+            )
+        self.segments[0][1].check_impact_params(k1, b)
+
+    @property
+    def impact_scale(self):
+        return self.segments[0][1].impact_scale
+
+    # -------------------------------
+    # term dictionary
+    # -------------------------------
+    def lookup(self, term):
+        slot = self._slot_of.get(term)
+        if slot is not None:
+            return slot
+        local = [r.lookup(term) for _, r in self.segments]
+        if max(local) < 0:
+            return -1
+        slot = len(self._local_slots)
+        self._slot_of[term] = slot
+        self._local_slots.append(local)
+        self._df.append(sum(int(r.df_at([s])[0]) for (_, r), s in zip(self.segments, local) if s >= 0))
+        return slot
+
+    def __contains__(self, term):
+        return self.lookup(term) >= 0
+
+    def terms(self):
+        """Distinct terms across all segments, in UTF-8 order."""
+        merged = heapq.merge(*[
+            ((term.encode("utf-8"), term) for term in r.terms()) for _, r in self.segments
+        ])
+        last = None
+        for raw, term in merged:
+            if raw != last:
+                last = raw
+                yield term
+
+    def __len__(self):
+        return sum(1 for _ in self.terms())
+
+    def df(self, term):
+        slot = self.lookup(term)
+        return self._df[slot] if slot >= 0 else 0
+
+    def df_at(self, slots):
+        return np.asarray(self._df, dtype=np.int64)[np.asarray(slots, dtype=np.int64)]
+
+    # -------------------------------
+    # postings
+    # -------------------------------
+    def postings_at(self, slot):
+        doc_parts, tf_parts = [], []
+        for (doc_base, reader), local in zip(self.segments, self._local_slots[slot]):
+            if local >= 0:
+                doc_ids, tfs = reader.postings_at(local)
+                doc_parts.append(doc_ids + doc_base)
+                tf_parts.append(tfs)
+        return np.concatenate(doc_parts), np.concatenate(tf_parts)
+
+    def postings(self, term):
+        slot = self.lookup(term)
+        if slot < 0:
+            return None
+        return self.postings_at(slot)
+
+    def postings_many(self, slots):
+        """Same contract as PostingsIndex.postings_many, gathered per segment."""
+        if len(self.segments) == 1:
+            return self.segments[0][1].postings_many([self._local_slots[s][0] for s in slots])
+
+        pos_parts, doc_parts, tf_parts = [], [], []
+        for seg, (doc_base, reader) in enumerate(self.segments):
+            local = np.array([self._local_slots[s][seg] for s in slots], dtype=np.int64)
+            present = np.flatnonzero(local >= 0)
+            if not len(present):
+                continue
+            term_pos, doc_ids, tfs = reader.postings_many(local[present])
+            pos_parts.append(present[term_pos])
+            doc_parts.append(doc_ids + doc_base)
+            tf_parts.append(tfs)
+
+        if not pos_parts:
+            return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                    np.zeros(0, dtype=np.uint32))
+        term_pos = np.concatenate(pos_parts)
+        # group by term like PostingsIndex; stable keeps doc ids ascending
+        order = np.argsort(term_pos, kind="stable")
+        return (term_pos[order],
+                np.concatenate(doc_parts)[order],
+                np.concatenate(tf_parts).astype(np.uint32)[order])
+
+    def impacts_many(self, slots):
+        reader = self.segments[0][1]
+        if len(self.segments) > 1:
+            raise ValueError(f"{self.index_dir} has more than one segment, no impacts")
+        return reader.impacts_many([self._local_slots[s][0] for s in slots])
+
+    # -------------------------------
+    # lifecycle
+    # -------------------------------
+    def close(self):
+        for reader in self._open.values():
+            reader.close()
+        self._open = {}
+        self.segments = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()